@@ -1,51 +1,130 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Response, status
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import AsyncMongoClient, IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict
+from contextvars import ContextVar
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from typing import List, Literal, Optional, Dict
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
 import hashlib
+import hmac
+import time
+from cachetools import TLRUCache, TTLCache
+import argon2
 import httpx
 import asyncio
+import re
+from functools import lru_cache
 import anthropic
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+import orjson
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware so BSON dates come back as UTC-aware datetimes, matching what we store
+client = AsyncMongoClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 # JWT configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION = timedelta(days=7)
+# Precomputed once: key bytes, expiry in seconds and a reusable codec instance
+_JWT_KEY = JWT_SECRET.encode()
+_JWT_EXPIRATION_SECONDS = int(JWT_EXPIRATION.total_seconds())
+_JWT_ALGORITHMS = [JWT_ALGORITHM]
+_jwt = jwt.PyJWT()
+
+# Verified tokens -> (user_id, exp), so repeat requests skip the HMAC check and JSON parse.
+# Each entry lives until the token's own exp, capped at JWT_CACHE_MAX_TTL seconds.
+JWT_CACHE_MAX_TTL = 300
+_jwt_cache = TLRUCache(
+    maxsize=4096,
+    ttu=lambda token, value, now: min(value[1], now + JWT_CACHE_MAX_TTL),
+    timer=time.time
+)
 
 # LLM configuration
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY')
+# One async client for the whole process so its connection pool is reused across turns
+llm_client = anthropic.AsyncAnthropic(api_key=EMERGENT_LLM_KEY)
 
 # WhatsApp service configuration  
 WHATSAPP_SERVICE_URL = os.environ.get('WHATSAPP_SERVICE_URL', 'http://localhost:3001')
 
+# Test deployments only: enables the /test/* helper routes
+TEST_MODE = os.environ.get('TEST_MODE', '').lower() in ('1', 'true', 'yes')
+
+class MongoJSONResponse(ORJSONResponse):
+    """orjson-backed response that also copes with non-native types such as ObjectId"""
+    def render(self, content) -> bytes:
+        return orjson.dumps(
+            content,
+            default=str,
+            option=orjson.OPT_NON_STR_KEYS
+        )
+
+def model_response(model: BaseModel) -> Response:
+    """Serialize a model straight to JSON in pydantic-core, skipping FastAPI's dump/re-validate pass"""
+    # Models here are freshly validated or built with model_construct from trusted documents
+    return Response(model.model_dump_json(warnings=False), media_type="application/json")
+
+# Per-request clock: the first utc_now() in an API request reads the clock, later calls reuse it
+_request_clock: ContextVar[Optional[list]] = ContextVar("request_clock", default=None)
+
+async def start_request_clock():
+    """Router dependency giving each API request its own lazily-read timestamp"""
+    _request_clock.set([])
+
+def utc_now() -> datetime:
+    """Current UTC time, read at most once per API request (always fresh outside one)"""
+    clock = _request_clock.get()
+    if clock is None:
+        return datetime.now(timezone.utc)
+    if not clock:
+        clock.append(datetime.now(timezone.utc))
+    return clock[0]
+
 # Create the main app
-app = FastAPI()
-api_router = APIRouter(prefix="/api")
+app = FastAPI(default_response_class=MongoJSONResponse)
+api_router = APIRouter(
+    prefix="/api",
+    default_response_class=MongoJSONResponse,
+    dependencies=[Depends(start_request_clock)]
+)
 security = HTTPBearer()
 
+# ID generation: carve v4 UUIDs out of one 4 KiB urandom read instead of a syscall per ID
+def _uuid_pool():
+    while True:
+        buf = os.urandom(4096)
+        for i in range(0, 4096, 16):
+            # version=4 sets the RFC 4122 version and variant bits
+            yield uuid.UUID(bytes=buf[i:i + 16], version=4)
+
+_uuid_source = _uuid_pool()
+
+def new_id() -> str:
+    # 32-char hex form: no dash formatting, and smaller documents and index keys
+    return next(_uuid_source).hex
+
 # Pydantic Models
 class User(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     username: str
     email: str
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=utc_now)
     personality_profile: Dict = Field(default_factory=dict)
     preferences: Dict = Field(default_factory=dict)
 
@@ -63,6 +142,10 @@ class TokenResponse(BaseModel):
     token_type: str
     user: User
 
+class TestBootstrapResponse(TokenResponse):
+    profile: User
+    quiz: Dict
+
 class PersonalityQuiz(BaseModel):
     question_id: str
     question: str
@@ -73,13 +156,14 @@ class PersonalityUpdate(BaseModel):
     answers: List[PersonalityQuiz]
 
 class Task(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     user_id: str
     title: str
     description: str = ""
     due_date: Optional[datetime] = None
     priority: str = "medium"  # low, medium, high
     completed: bool = False
+    # Always a fresh read: GET /tasks sorts on it, and one batch request creates several
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     reminder_sent: bool = False
 
@@ -96,11 +180,25 @@ class TaskUpdate(BaseModel):
     priority: Optional[str] = None
     completed: Optional[bool] = None
 
+class TaskBatchOp(TaskUpdate):
+    op: Literal["create", "update", "delete"]
+    # Target task for update/delete; optional client-chosen id for create
+    id: Optional[str] = None
+
+# Ops run one after another, so bound how much work a single request can queue
+TASK_BATCH_MAX_OPS = 100
+
+class TaskBatchRequest(BaseModel):
+    ops: List[TaskBatchOp] = Field(max_length=TASK_BATCH_MAX_OPS)
+
+_task_list_adapter = TypeAdapter(List[Task])
+
 class ChatMessage(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     user_id: str
     content: str
     is_ai: bool = False
+    # Always a fresh read: a reply must sort after the message it answers within one request
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     session_id: str
 
@@ -125,7 +223,7 @@ class WhatsAppResponse(BaseModel):
     success: bool = True
 
 class WelfareCheckSettings(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     user_id: str
     phone_number: str
     enabled: bool = True
@@ -133,7 +231,7 @@ class WelfareCheckSettings(BaseModel):
     morning_time: str = "09:00"  # HH:MM format
     welfare_check_days: int = 3  # Days of inactivity before welfare check
     custom_morning_message: Optional[str] = None
-    last_activity: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    last_activity: datetime = Field(default_factory=utc_now)
     last_welfare_check: Optional[datetime] = None
 
 class WelfareCheckCreate(BaseModel):
@@ -143,65 +241,80 @@ class WelfareCheckCreate(BaseModel):
     welfare_check_days: int = 3
     custom_morning_message: Optional[str] = None
 
+# Public user fields only - keeps password_hash and phone_number out of responses
+USER_PROJECTION = {"_id": 0, **{field: 1 for field in User.model_fields}}
+LOGIN_PROJECTION = {**USER_PROJECTION, "password_hash": 1}
+
 # Helper Functions
+password_hasher = argon2.PasswordHasher()
+
+# Recent successful verifications, so bursty re-logins skip the Argon2 work
+_password_cache = TTLCache(maxsize=512, ttl=30)
+
 def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Argon2id hash in PHC string format (salt and parameters included)"""
+    return password_hasher.hash(password)
 
 def verify_password(password: str, hashed: str) -> bool:
-    return hash_password(password) == hashed
+    if hashed.startswith("$argon2"):
+        try:
+            return password_hasher.verify(hashed, password)
+        except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHashError):
+            return False
+    # Legacy unsalted SHA-256 hex digests
+    return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), hashed)
+
+def password_needs_rehash(hashed: str) -> bool:
+    if hashed.startswith("$argon2"):
+        return password_hasher.check_needs_rehash(hashed)
+    return True
+
+async def check_password(username: str, password: str, hashed: str) -> bool:
+    """Verify off the event loop, remembering successes briefly"""
+    # Keyed on the stored hash too, so a password change invalidates the entry
+    cache_key = hashlib.sha256(
+        b"\0".join((username.encode(), password.encode(), hashed.encode()))
+    ).digest()
+    if cache_key in _password_cache:
+        return True
+    verified = await asyncio.to_thread(verify_password, password, hashed)
+    if verified:
+        _password_cache[cache_key] = True
+    return verified
 
 def create_access_token(data: dict):
     to_encode = data.copy()
-    expire = datetime.now(timezone.utc) + JWT_EXPIRATION
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    # Integer epoch seconds - what PyJWT would convert a datetime to anyway
+    to_encode["exp"] = int(time.time()) + _JWT_EXPIRATION_SECONDS
+    return _jwt.encode(to_encode, _JWT_KEY, algorithm=JWT_ALGORITHM)
 
-def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+async def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+    # async so FastAPI calls it on the event loop rather than via the threadpool
+    token = credentials.credentials
+    cached = _jwt_cache.get(token)
+    if cached is not None:
+        user_id, exp = cached
+        if exp > time.time():
+            return user_id
+        _jwt_cache.pop(token, None)
+    
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = _jwt.decode(token, _JWT_KEY, algorithms=_JWT_ALGORITHMS)
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid token")
+        _jwt_cache[token] = (user_id, payload.get("exp", 0))
         return user_id
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-def prepare_for_mongo(data):
-    """Convert datetime objects to ISO strings for MongoDB storage"""
-    if isinstance(data, dict):
-        return {k: prepare_for_mongo(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [prepare_for_mongo(item) for item in data]
-    elif isinstance(data, datetime):
-        return data.isoformat()
-    return data
-
-def parse_from_mongo(item):
-    """Convert ISO strings back to datetime objects from MongoDB and handle ObjectIds"""
-    from bson import ObjectId
-    
-    if isinstance(item, ObjectId):
-        return str(item)
-    elif isinstance(item, dict):
-        # Remove MongoDB's _id field if present, as it causes serialization issues
-        parsed = {k: parse_from_mongo(v) for k, v in item.items() if k != '_id'}
-        # Convert timestamp fields
-        for field in ['created_at', 'due_date', 'timestamp']:
-            if field in parsed and isinstance(parsed[field], str):
-                try:
-                    parsed[field] = datetime.fromisoformat(parsed[field].replace('Z', '+00:00'))
-                except:
-                    pass
-        return parsed
-    elif isinstance(item, list):
-        return [parse_from_mongo(i) for i in item]
-    return item
+# Phrases in a user message that hint at something to add to the to-do list.
+# Compiled into one alternation so a message is scanned once however long the list grows.
+TASK_KEYWORDS = ("need to", "have to", "should", "must", "remind me", "don't forget")
+TASK_RE = re.compile(r"\b(?:%s)\b" % "|".join(map(re.escape, TASK_KEYWORDS)), re.IGNORECASE)
 
 # AI Personality System
-def build_personality_prompt(personality_profile: Dict, user_context: str = "") -> str:
-    """Build a system prompt based on user's personality profile"""
-    
-    base_prompt = """
+BASE_PROMPT_HEAD = """
 You are an AI companion and life assistant. You adapt your personality and communication style based on the user's profile.
 You help with:
 - Friendly conversations and emotional support
@@ -215,38 +328,61 @@ Always be:
 - Genuine and warm in your responses
 - Proactive in suggesting tasks when relevant
 """
+
+BASE_PROMPT_TAIL = """
+
+Important: If you notice the user mentioning tasks they need to do, or if they seem overwhelmed, 
+subtly suggest they add these as tasks to their to-do list. Be natural about it - don't force it.
+
+End your responses with encouragement when appropriate.
+"""
+
+@lru_cache(maxsize=1024)
+def _personality_section(profile_items: tuple) -> str:
+    """Render the personality block once per distinct profile"""
+    return "\n\nUser's Personality Profile:\n" + "".join(f"- {key}: {value}\n" for key, value in profile_items)
+
+def build_personality_prompt(personality_profile: Dict, user_context: str = "") -> str:
+    """Build a system prompt based on user's personality profile"""
+    parts = [BASE_PROMPT_HEAD]
     
     if personality_profile:
-        personality_text = "\n\nUser's Personality Profile:\n"
-        for key, value in personality_profile.items():
-            personality_text += f"- {key}: {value}\n"
-        base_prompt += personality_text
+        parts.append(_personality_section(tuple(sorted(personality_profile.items()))))
     
     if user_context:
-        base_prompt += f"\n\nContext: {user_context}"
+        parts.append(f"\n\nContext: {user_context}")
     
-    base_prompt += """
+    parts.append(BASE_PROMPT_TAIL)
+    return "".join(parts)
 
-Important: If you notice the user mentioning tasks they need to do, or if they seem overwhelmed, 
-subtly suggest they add these as tasks to their to-do list. Be natural about it - don't force it.
+@lru_cache(maxsize=1024)
+def build_whatsapp_prompt(profile_items: tuple) -> str:
+    """WhatsApp-specific system prompt, built once per distinct personality profile"""
+    return f"""
+You are the user's AI companion communicating via WhatsApp. Keep responses:
+- Concise and mobile-friendly (max 2-3 sentences usually)
+- Warm and personal based on their personality
+- Use appropriate emojis sparingly
+- If they mention tasks, offer to help manage them
 
-End your responses with encouragement when appropriate.
+User's personality: {dict(profile_items)}
+
+Be helpful, supportive, and remember you're their personal AI friend. If they ask about tasks or reminders, let them know you can help manage those too.
 """
-    
-    return base_prompt
 
 # Routes
 
 # Authentication Routes
-@api_router.post("/auth/register", response_model=TokenResponse)
-async def register(user_data: UserCreate):
-    # Check if user exists
-    existing_user = await db.users.find_one({"username": user_data.username})
+async def create_user(user_data: UserCreate) -> User:
+    """Insert a new user, raising 400 if the username or email is taken"""
+    # Check if user exists - one round trip covers both unique fields
+    existing_user = await db.users.find_one(
+        {"$or": [{"username": user_data.username}, {"email": user_data.email}]},
+        {"_id": 0, "username": 1, "email": 1}
+    )
     if existing_user:
-        raise HTTPException(status_code=400, detail="Username already exists")
-    
-    existing_email = await db.users.find_one({"email": user_data.email})
-    if existing_email:
+        if existing_user.get("username") == user_data.username:
+            raise HTTPException(status_code=400, detail="Username already exists")
         raise HTTPException(status_code=400, detail="Email already exists")
     
     # Create new user
@@ -255,50 +391,72 @@ async def register(user_data: UserCreate):
         email=user_data.email
     )
     
-    user_dict = user.dict()
-    user_dict["password_hash"] = hash_password(user_data.password)
-    user_dict = prepare_for_mongo(user_dict)
+    user_dict = user.model_dump()
+    # Argon2 is CPU-bound; keep it off the event loop
+    user_dict["password_hash"] = await asyncio.to_thread(hash_password, user_data.password)
+    
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError as e:
+        # A concurrent registration won the race; the unique index caught it
+        key_pattern = (e.details or {}).get("keyPattern", {})
+        field = "Email" if "email" in key_pattern else "Username"
+        raise HTTPException(status_code=400, detail=f"{field} already exists")
     
-    await db.users.insert_one(user_dict)
+    return user
+
+@api_router.post("/auth/register", response_model=TokenResponse)
+async def register(user_data: UserCreate):
+    user = await create_user(user_data)
     
     # Create token
     token = create_access_token({"sub": user.id})
     
-    return TokenResponse(
+    return model_response(TokenResponse(
         access_token=token,
         token_type="bearer",
         user=user
-    )
+    ))
 
 @api_router.post("/auth/login", response_model=TokenResponse)
 async def login(user_data: UserLogin):
-    user_doc = await db.users.find_one({"username": user_data.username})
-    if not user_doc or not verify_password(user_data.password, user_doc.get("password_hash", "")):
+    user_doc = await db.users.find_one({"username": user_data.username}, LOGIN_PROJECTION)
+    if not user_doc or not await check_password(user_data.username, user_data.password, user_doc.get("password_hash", "")):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    user_doc = parse_from_mongo(user_doc)
-    user = User(**{k: v for k, v in user_doc.items() if k != "password_hash"})
+    # Upgrade legacy SHA-256 hashes now that we have the plaintext
+    if password_needs_rehash(user_doc.get("password_hash", "")):
+        await db.users.update_one(
+            {"id": user_doc["id"]},
+            {"$set": {"password_hash": await asyncio.to_thread(hash_password, user_data.password)}}
+        )
+    
+    # Stored users were validated on the way in, so skip re-validation on read
+    user = User.model_construct(**{k: user_doc[k] for k in User.model_fields if k in user_doc})
     
     token = create_access_token({"sub": user.id})
     
-    return TokenResponse(
+    return model_response(TokenResponse(
         access_token=token,
         token_type="bearer",
         user=user
-    )
+    ))
 
 # Personality Routes
-@api_router.get("/personality/quiz")
-async def get_personality_quiz():
-    """Get personality quiz questions"""
-    questions = [
+PERSONALITY_QUIZ = {
+    "questions": [
         {"id": "communication", "question": "How do you prefer to communicate?", "options": ["Direct and concise", "Friendly and detailed", "Casual and fun", "Formal and structured"]},
         {"id": "motivation", "question": "What motivates you most?", "options": ["Achievement and success", "Learning and growth", "Helping others", "Creative expression"]},
         {"id": "stress", "question": "How do you handle stress?", "options": ["Take action immediately", "Think it through carefully", "Talk to someone", "Take time alone to process"]},
         {"id": "work_style", "question": "What's your ideal work style?", "options": ["Structured with clear deadlines", "Flexible with creative freedom", "Collaborative with others", "Independent with minimal supervision"]},
         {"id": "goals", "question": "How do you approach goals?", "options": ["Break them into small steps", "Focus on the big picture", "Set ambitious targets", "Keep them flexible and adaptable"]}
     ]
-    return {"questions": questions}
+}
+
+@api_router.get("/personality/quiz")
+async def get_personality_quiz():
+    """Get personality quiz questions"""
+    return PERSONALITY_QUIZ
 
 @api_router.post("/personality/update")
 async def update_personality(personality_data: PersonalityUpdate, user_id: str = Depends(get_current_user_id)):
@@ -318,52 +476,57 @@ async def update_personality(personality_data: PersonalityUpdate, user_id: str =
     return {"message": "Personality profile updated successfully"}
 
 # Chat Routes
+async def get_recent_messages(user_id: str, session_id: str, limit: int = 10) -> List[dict]:
+    """Get the last `limit` messages of a session, already back in chronological order"""
+    cursor = await db.chat_messages.aggregate([
+        {"$match": {"user_id": user_id, "session_id": session_id}},
+        {"$sort": {"timestamp": -1}},
+        {"$limit": limit},
+        {"$sort": {"timestamp": 1}},
+        {"$project": {"_id": 0, "is_ai": 1, "content": 1}}
+    ])
+    return await cursor.to_list(limit)
+
 @api_router.post("/chat", response_model=ChatResponse)
 async def chat_with_ai(chat_request: ChatRequest, user_id: str = Depends(get_current_user_id)):
     """Chat with the AI companion"""
     
-    # Get user profile
-    user_doc = await db.users.find_one({"id": user_id})
-    if not user_doc:
+    # Generate session ID if not provided
+    session_id = chat_request.session_id or new_id()
+    
+    # Fetch the profile and recent history concurrently - neither depends on the other
+    user_doc, recent_messages = await asyncio.gather(
+        db.users.find_one({"id": user_id}, {"_id": 0, "personality_profile": 1}),
+        get_recent_messages(user_id, session_id)
+    )
+    if user_doc is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    user_doc = parse_from_mongo(user_doc)
     personality_profile = user_doc.get("personality_profile", {})
     
-    # Generate session ID if not provided
-    session_id = chat_request.session_id or str(uuid.uuid4())
-    
-    # Get recent chat history for context
-    recent_messages = await db.chat_messages.find(
-        {"user_id": user_id, "session_id": session_id}
-    ).sort("timestamp", -1).limit(10).to_list(10)
-    
     # Build context from recent messages
     context = ""
     if recent_messages:
-        context = "Recent conversation:\n"
-        for msg in reversed(recent_messages):  # Reverse to get chronological order
-            sender = "User" if not msg.get("is_ai") else "Assistant"
-            context += f"{sender}: {msg.get('content', '')}\n"
+        context = "Recent conversation:\n" + "".join(
+            f"{'Assistant' if msg.get('is_ai') else 'User'}: {msg.get('content', '')}\n"
+            for msg in recent_messages
+        )
     
-    # Save user message
+    # User message is persisted together with the reply below
     user_message = ChatMessage(
         user_id=user_id,
         content=chat_request.message,
         is_ai=False,
         session_id=session_id
     )
-    user_msg_dict = prepare_for_mongo(user_message.dict())
-    await db.chat_messages.insert_one(user_msg_dict)
+    user_msg_dict = user_message.model_dump()
     
     try:
-        # Initialize Claude chat with Anthropic SDK
+        # Build the personalised system prompt
         system_prompt = build_personality_prompt(personality_profile, context)
         
-        client = anthropic.Anthropic(api_key=EMERGENT_LLM_KEY)
-        
         # Send message to Claude
-        message = client.messages.create(
+        message = await llm_client.messages.create(
             model="claude-sonnet-4-20250514",
             max_tokens=1024,
             system=system_prompt,
@@ -373,30 +536,28 @@ async def chat_with_ai(chat_request: ChatRequest, user_id: str = Depends(get_cur
         )
         ai_response = message.content[0].text
         
-        # Save AI response
+        # Save user message and AI response in one round trip
         ai_message = ChatMessage(
             user_id=user_id,
             content=ai_response,
             is_ai=True,
             session_id=session_id
         )
-        ai_msg_dict = prepare_for_mongo(ai_message.dict())
-        await db.chat_messages.insert_one(ai_msg_dict)
+        ai_msg_dict = ai_message.model_dump()
+        await db.chat_messages.insert_many([user_msg_dict, ai_msg_dict])
         
         # Extract potential task suggestions (basic keyword detection)
         suggested_tasks = []
-        message_lower = chat_request.message.lower()
-        task_keywords = ["need to", "have to", "should", "must", "remind me", "don't forget"]
-        if any(keyword in message_lower for keyword in task_keywords):
+        if TASK_RE.search(chat_request.message):
             # This is a simple implementation - in a real app, you'd use more sophisticated NLP
             potential_tasks = ["Follow up on this conversation", "Review mentioned items"]
             suggested_tasks = potential_tasks
         
-        return ChatResponse(
+        return model_response(ChatResponse(
             message=ai_response,
             session_id=session_id,
             suggested_tasks=suggested_tasks
-        )
+        ))
         
     except Exception as e:
         logging.error(f"Error in AI chat: {e}")
@@ -409,77 +570,130 @@ async def chat_with_ai(chat_request: ChatRequest, user_id: str = Depends(get_cur
             is_ai=True,
             session_id=session_id
         )
-        ai_msg_dict = prepare_for_mongo(ai_message.dict())
-        await db.chat_messages.insert_one(ai_msg_dict)
+        ai_msg_dict = ai_message.model_dump()
+        await db.chat_messages.insert_many([user_msg_dict, ai_msg_dict])
         
-        return ChatResponse(
+        return model_response(ChatResponse(
             message=fallback_response,
             session_id=session_id
-        )
+        ))
 
 @api_router.get("/chat/history/{session_id}")
 async def get_chat_history(session_id: str, user_id: str = Depends(get_current_user_id)):
-    """Get chat history for a session"""
+    """Stream chat history for a session as NDJSON, one message per line"""
     try:
-        messages = await db.chat_messages.find(
-            {"user_id": user_id, "session_id": session_id}
-        ).sort("timestamp", 1).to_list(100)
-        
-        parsed_messages = []
-        for msg in messages:
-            try:
-                parsed_msg = parse_from_mongo(msg)
-                parsed_messages.append(parsed_msg)
-            except Exception as e:
-                logging.error(f"Error parsing message {msg.get('id', 'unknown')}: {e}")
-                # Skip malformed messages but continue processing others
-                continue
-        
-        return {"messages": parsed_messages}
+        cursor = await db.chat_messages.aggregate([
+            {"$match": {"user_id": user_id, "session_id": session_id}},
+            {"$sort": {"timestamp": 1}},
+            {"$limit": 100},
+            {"$project": {"_id": 0}}
+        ], batchSize=50)
     except Exception as e:
         logging.error(f"Error fetching chat history: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch chat history")
+    
+    async def stream_messages():
+        async for msg in cursor:
+            yield orjson.dumps(msg, default=str) + b"\n"
+    
+    return StreamingResponse(stream_messages(), media_type="application/x-ndjson")
 
 # Task Management Routes
 @api_router.get("/tasks", response_model=List[Task])
 async def get_tasks(user_id: str = Depends(get_current_user_id)):
     """Get all tasks for the current user"""
-    tasks = await db.tasks.find({"user_id": user_id}).sort("created_at", -1).to_list(100)
-    return [Task(**parse_from_mongo(task)) for task in tasks]
+    tasks = await db.tasks.find({"user_id": user_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
+    # Validate + dump in pydantic-core: model defaults fill gaps in older documents and
+    # datetimes come out exactly as the single-task endpoints render them
+    return Response(_task_list_adapter.dump_json(_task_list_adapter.validate_python(tasks)), media_type="application/json")
 
-@api_router.post("/tasks", response_model=Task)
-async def create_task(task_data: TaskCreate, user_id: str = Depends(get_current_user_id)):
-    """Create a new task"""
+async def insert_task(user_id: str, task_data: TaskCreate, task_id: Optional[str] = None) -> Task:
     task = Task(
         user_id=user_id,
-        **task_data.dict()
+        **task_data.model_dump()
     )
+    if task_id:
+        task.id = task_id
     
-    task_dict = prepare_for_mongo(task.dict())
+    task_dict = task.model_dump()
     await db.tasks.insert_one(task_dict)
-    
     return task
 
+async def apply_task_update(user_id: str, task_id: str, task_data: TaskUpdate) -> Optional[dict]:
+    """Apply the fields the client sent and return the updated task, or None if it isn't theirs"""
+    # Only fields the client actually sent; explicit nulls are ignored as before
+    update_data = task_data.model_dump(include=set(TaskUpdate.model_fields), exclude_unset=True, exclude_none=True)
+    task_filter = {"id": task_id, "user_id": user_id}
+    
+    # Ownership check, update and read-back in a single command
+    if update_data:
+        return await db.tasks.find_one_and_update(
+            task_filter,
+            {"$set": update_data},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    # Mongo rejects an empty $set; nothing to change, so just return the task
+    return await db.tasks.find_one(task_filter, {"_id": 0})
+
+@api_router.post("/tasks", response_model=Task)
+async def create_task(task_data: TaskCreate, user_id: str = Depends(get_current_user_id)):
+    """Create a new task"""
+    task = await insert_task(user_id, task_data)
+    
+    return model_response(task)
+
+@api_router.post("/tasks/batch")
+async def batch_tasks(batch: TaskBatchRequest, user_id: str = Depends(get_current_user_id)):
+    """Apply several create/update/delete ops in order and report each one's outcome.
+    
+    Ops are not transactional: a failed op is reported and the rest still run.
+    """
+    results = []
+    for op in batch.ops:
+        result = {"op": op.op, "id": op.id, "status": 200}
+        try:
+            if op.op == "create":
+                # Update-only fields (e.g. completed) would otherwise be silently dropped
+                unsupported = op.model_fields_set - set(TaskCreate.model_fields) - {"op", "id"}
+                if unsupported:
+                    result.update(status=422, detail=f"Not allowed on create: {', '.join(sorted(unsupported))}")
+                    results.append(result)
+                    continue
+                task = await insert_task(
+                    user_id,
+                    TaskCreate(**op.model_dump(include=set(TaskCreate.model_fields), exclude_none=True)),
+                    op.id
+                )
+                result.update(id=task.id, task=task.model_dump())
+            elif not op.id:
+                result.update(status=422, detail="id is required")
+            elif op.op == "update":
+                updated_task = await apply_task_update(user_id, op.id, op)
+                if updated_task:
+                    result["task"] = updated_task
+                else:
+                    result.update(status=404, detail="Task not found")
+            else:
+                deleted = await db.tasks.delete_one({"id": op.id, "user_id": user_id})
+                if deleted.deleted_count == 0:
+                    result.update(status=404, detail="Task not found")
+        except ValidationError as e:
+            result.update(status=422, detail=e.errors(include_url=False, include_context=False))
+        except DuplicateKeyError:
+            result.update(status=409, detail="Task id already exists")
+        results.append(result)
+    
+    return {"results": results}
+
 @api_router.put("/tasks/{task_id}", response_model=Task)
 async def update_task(task_id: str, task_data: TaskUpdate, user_id: str = Depends(get_current_user_id)):
     """Update a task"""
-    # Check if task exists and belongs to user
-    existing_task = await db.tasks.find_one({"id": task_id, "user_id": user_id})
-    if not existing_task:
+    updated_task = await apply_task_update(user_id, task_id, task_data)
+    if not updated_task:
         raise HTTPException(status_code=404, detail="Task not found")
     
-    # Update task
-    update_data = {k: v for k, v in task_data.dict().items() if v is not None}
-    update_data = prepare_for_mongo(update_data)
-    
-    await db.tasks.update_one(
-        {"id": task_id, "user_id": user_id},
-        {"$set": update_data}
-    )
-    
-    # Get updated task
-    updated_task = await db.tasks.find_one({"id": task_id, "user_id": user_id})
-    return Task(**parse_from_mongo(updated_task))
+    return model_response(Task(**updated_task))
 
 @api_router.delete("/tasks/{task_id}")
 async def delete_task(task_id: str, user_id: str = Depends(get_current_user_id)):
@@ -494,12 +708,31 @@ async def delete_task(task_id: str, user_id: str = Depends(get_current_user_id))
 @api_router.get("/profile", response_model=User)
 async def get_profile(user_id: str = Depends(get_current_user_id)):
     """Get current user profile"""
-    user_doc = await db.users.find_one({"id": user_id})
+    user_doc = await db.users.find_one({"id": user_id}, USER_PROJECTION)
     if not user_doc:
         raise HTTPException(status_code=404, detail="User not found")
     
-    user_doc = parse_from_mongo(user_doc)
-    return User(**{k: v for k, v in user_doc.items() if k != "password_hash"})
+    return model_response(User.model_validate(user_doc))
+
+# Test Support Routes
+@api_router.post("/test/bootstrap", response_model=TestBootstrapResponse)
+async def test_bootstrap(user_data: UserCreate, x_test_mode: Optional[str] = Header(None)):
+    """Register a user and return its token, profile and the quiz in one round trip"""
+    # Only exists on test deployments, and only for callers that ask for it
+    if not TEST_MODE or x_test_mode != "1":
+        raise HTTPException(status_code=404, detail="Not Found")
+    
+    user = await create_user(user_data)
+    # Read the profile back the same way GET /profile does
+    profile_doc = await db.users.find_one({"id": user.id}, USER_PROJECTION)
+    
+    return model_response(TestBootstrapResponse(
+        access_token=create_access_token({"sub": user.id}),
+        token_type="bearer",
+        user=user,
+        profile=User.model_construct(**profile_doc),
+        quiz=PERSONALITY_QUIZ
+    ))
 
 # WhatsApp Integration Routes
 @api_router.post("/whatsapp/process", response_model=WhatsAppResponse)
@@ -510,7 +743,10 @@ async def process_whatsapp_message(message_data: WhatsAppMessage):
         message_text = message_data.message.strip()
 
         # Find user by phone number
-        user_doc = await db.users.find_one({"phone_number": phone_number})
+        user_doc = await db.users.find_one(
+            {"phone_number": phone_number},
+            {"_id": 0, "id": 1, "personality_profile": 1}
+        )
         
         if not user_doc:
             # Create new user or return onboarding message
@@ -518,12 +754,10 @@ async def process_whatsapp_message(message_data: WhatsAppMessage):
                 reply=f"👋 Hello! I'm your AI Companion. To get started, please register at {os.environ.get('FRONTEND_URL', 'our app')} and add your phone number to your profile. Then I can help you with tasks, reminders, and be your personal assistant!"
             )
         
-        user_doc = parse_from_mongo(user_doc)
-        
         # Update last activity for welfare check
         await db.welfare_settings.update_one(
             {"phone_number": phone_number},
-            {"$set": {"last_activity": datetime.now(timezone.utc)}},
+            {"$set": {"last_activity": utc_now()}},
             upsert=True
         )
         
@@ -545,26 +779,13 @@ async def process_whatsapp_with_ai(user_doc: dict, message_text: str) -> str:
         personality_profile = user_doc.get("personality_profile", {})
         
         # Build WhatsApp-specific system prompt
-        whatsapp_prompt = f"""
-You are the user's AI companion communicating via WhatsApp. Keep responses:
-- Concise and mobile-friendly (max 2-3 sentences usually)
-- Warm and personal based on their personality
-- Use appropriate emojis sparingly
-- If they mention tasks, offer to help manage them
-
-User's personality: {personality_profile}
-
-Be helpful, supportive, and remember you're their personal AI friend. If they ask about tasks or reminders, let them know you can help manage those too.
-"""
+        whatsapp_prompt = build_whatsapp_prompt(tuple(personality_profile.items()))
         
         # Get or create session for this user
         session_id = f"whatsapp_{user_doc['id']}"
         
-        # Initialize Claude chat with Anthropic SDK
-        client = anthropic.Anthropic(api_key=EMERGENT_LLM_KEY)
-        
         # Send message to Claude
-        message = client.messages.create(
+        message = await llm_client.messages.create(
             model="claude-sonnet-4-20250514",
             max_tokens=1024,
             system=whatsapp_prompt,
@@ -580,10 +801,11 @@ Be helpful, supportive, and remember you're their personal AI friend. If they as
             user_id=user_doc['id'],
             content=message_text,
             is_ai=False,
-            session_id=session_id
+            session_id=session_id,
+            # Same request timestamp as last_activity: when the message arrived
+            timestamp=utc_now()
         )
-        user_msg_dict = prepare_for_mongo(user_message.dict())
-        await db.chat_messages.insert_one(user_msg_dict)
+        user_msg_dict = user_message.model_dump()
         
         # AI response
         ai_message = ChatMessage(
@@ -592,8 +814,10 @@ Be helpful, supportive, and remember you're their personal AI friend. If they as
             is_ai=True,
             session_id=session_id
         )
-        ai_msg_dict = prepare_for_mongo(ai_message.dict())
-        await db.chat_messages.insert_one(ai_msg_dict)
+        ai_msg_dict = ai_message.model_dump()
+        
+        # Both messages in one round trip, user message first
+        await db.chat_messages.insert_many([user_msg_dict, ai_msg_dict], ordered=True)
         
         return ai_response
         
@@ -617,13 +841,14 @@ async def setup_whatsapp_integration(
     # Create or update welfare check settings
     welfare_settings = WelfareCheckSettings(
         user_id=user_id,
-        **settings.dict()
+        **settings.model_dump()
     )
     
-    settings_dict = prepare_for_mongo(welfare_settings.dict())
+    # Re-running setup must not reset the settings id or the server-owned last_welfare_check
+    settings_dict = welfare_settings.model_dump(exclude={"id", "last_welfare_check"})
     await db.welfare_settings.update_one(
         {"user_id": user_id},
-        {"$set": settings_dict},
+        {"$set": settings_dict, "$setOnInsert": {"id": welfare_settings.id}},
         upsert=True
     )
     
@@ -633,9 +858,8 @@ async def setup_whatsapp_integration(
 async def get_whatsapp_status():
     """Get WhatsApp service status"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{WHATSAPP_SERVICE_URL}/status", timeout=5.0)
-            return response.json()
+        response = await app.state.http.get("/status")
+        return response.json()
     except Exception as e:
         return {"connected": False, "error": str(e)}
 
@@ -643,22 +867,28 @@ async def get_whatsapp_status():
 async def get_whatsapp_qr():
     """Get QR code for WhatsApp authentication"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{WHATSAPP_SERVICE_URL}/qr", timeout=5.0)
-            return response.json()
+        response = await app.state.http.get("/qr")
+        return response.json()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get QR code: {str(e)}")
 
 @api_router.post("/whatsapp/send-welfare-check")
 async def send_welfare_check(user_id: str = Depends(get_current_user_id)):
     """Manually trigger welfare check for testing"""
-    user_doc = await db.users.find_one({"id": user_id})
+    user_doc = await db.users.find_one({"id": user_id}, {"_id": 0, "username": 1, "phone_number": 1})
     if not user_doc or not user_doc.get("phone_number"):
         raise HTTPException(status_code=404, detail="User not found or no phone number")
     
-    welfare_message = f"Hey {user_doc['username']}! 🌟 Just checking in on you. How are you doing today? Remember, I'm here if you need to talk or need help with anything!"
+    if await deliver_welfare_check(user_id, user_doc["username"], user_doc["phone_number"]):
+        return {"message": "Welfare check sent successfully"}
+    else:
+        raise HTTPException(status_code=500, detail="Failed to send welfare check")
+
+async def deliver_welfare_check(user_id: str, username: str, phone_number: str) -> bool:
+    """Send the welfare check-in message and record when it went out"""
+    welfare_message = f"Hey {username}! 🌟 Just checking in on you. How are you doing today? Remember, I'm here if you need to talk or need help with anything!"
     
-    success = await send_whatsapp_message(user_doc["phone_number"], welfare_message, "welfare_check")
+    success = await send_whatsapp_message(phone_number, welfare_message, "welfare_check")
     
     if success:
         # Update last welfare check time
@@ -666,24 +896,84 @@ async def send_welfare_check(user_id: str = Depends(get_current_user_id)):
             {"user_id": user_id},
             {"$set": {"last_welfare_check": datetime.now(timezone.utc)}}
         )
-        return {"message": "Welfare check sent successfully"}
-    else:
-        raise HTTPException(status_code=500, detail="Failed to send welfare check")
+    return success
+
+def as_utc_datetime(value) -> Optional[datetime]:
+    """Coerce a stored timestamp to an aware UTC datetime.
+    
+    WhatsApp setup used to store last_activity as an ISO string; those
+    documents stay that way until the user next messages us.
+    """
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+async def run_welfare_checks():
+    """Scheduled job: check in on users who have been quiet longer than their welfare_check_days"""
+    now = datetime.now(timezone.utc)
+    # Coarse, index-backed filter; each user's own window is applied below.
+    # BSON never orders strings against dates, so legacy ISO-string last_activity
+    # values need their own branch or they would never be selected.
+    candidates = await db.welfare_settings.find(
+        {
+            "enabled": True,
+            "user_id": {"$exists": True},
+            "$or": [
+                {"last_activity": {"$lt": now - timedelta(days=1)}},
+                {"last_activity": {"$type": "string"}}
+            ]
+        },
+        {"_id": 0, "user_id": 1, "welfare_check_days": 1, "last_activity": 1, "last_welfare_check": 1}
+    ).to_list(None)
+    
+    due_user_ids = []
+    for settings in candidates:
+        # One malformed settings document must not stop everyone else's check-in
+        try:
+            last_activity = as_utc_datetime(settings["last_activity"])
+            if last_activity is None:
+                logging.warning(f"Unreadable last_activity for user {settings['user_id']}: {settings['last_activity']!r}")
+                continue
+            if last_activity >= now - timedelta(days=max(settings.get("welfare_check_days", 3), 1)):
+                continue
+            # Only one check-in per stretch of inactivity
+            last_check = as_utc_datetime(settings.get("last_welfare_check"))
+            if last_check and last_check > last_activity:
+                continue
+        except Exception as e:
+            logging.error(f"Skipping welfare settings for user {settings.get('user_id')}: {e}")
+            continue
+        due_user_ids.append(settings["user_id"])
+    
+    if not due_user_ids:
+        return
+    
+    users = await db.users.find(
+        {"id": {"$in": due_user_ids}, "phone_number": {"$exists": True}},
+        {"_id": 0, "id": 1, "username": 1, "phone_number": 1}
+    ).to_list(None)
+    for user_doc in users:
+        if not await deliver_welfare_check(user_doc["id"], user_doc["username"], user_doc["phone_number"]):
+            logging.error(f"Scheduled welfare check failed for user {user_doc['id']}")
 
 async def send_whatsapp_message(phone_number: str, message: str, message_type: str = "general") -> bool:
     """Helper function to send WhatsApp messages"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{WHATSAPP_SERVICE_URL}/schedule",
-                json={
-                    "phone_number": phone_number,
-                    "message": message,
-                    "type": message_type
-                },
-                timeout=10.0
-            )
-            return response.json().get("success", False)
+        response = await app.state.http.post(
+            "/schedule",
+            json={
+                "phone_number": phone_number,
+                "message": message,
+                "type": message_type
+            },
+            timeout=10.0
+        )
+        return response.json().get("success", False)
     except Exception as e:
         logging.error(f"Failed to send WhatsApp message: {e}")
         return False
@@ -712,6 +1002,61 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Indexes backing the hot queries, one create_indexes call per collection
+MONGO_INDEXES = {
+    "users": [
+        IndexModel("id", unique=True),
+        IndexModel("username", unique=True),
+        IndexModel("email", unique=True),
+        IndexModel("phone_number")
+    ],
+    "tasks": [
+        IndexModel([("user_id", 1), ("created_at", -1)]),
+        IndexModel([("user_id", 1), ("id", 1)], unique=True)
+    ],
+    "chat_messages": [
+        IndexModel([("user_id", 1), ("session_id", 1), ("timestamp", -1)])
+    ],
+    "welfare_settings": [
+        # WhatsApp activity upserts by phone number can create settings without a user_id
+        IndexModel("user_id", unique=True, partialFilterExpression={"user_id": {"$exists": True}}),
+        IndexModel("phone_number"),
+        IndexModel([("enabled", 1), ("last_activity", 1)])
+    ]
+}
+
+@app.on_event("startup")
+async def ensure_indexes():
+    """Create the indexes backing our hot queries (no-op if they already exist)"""
+    for collection, indexes in MONGO_INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except Exception as e:
+            # Don't take the API down over an index build (e.g. pre-existing duplicates)
+            logging.error(f"Failed to create MongoDB indexes on {collection}: {e}")
+
+@app.on_event("startup")
+async def open_http_client():
+    """Shared keep-alive client for calls to the WhatsApp service"""
+    app.state.http = httpx.AsyncClient(
+        base_url=WHATSAPP_SERVICE_URL,
+        timeout=5.0,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+    )
+
+@app.on_event("startup")
+async def start_scheduler():
+    """Run welfare checks on the app's own event loop - no extra thread or pool"""
+    app.state.scheduler = AsyncIOScheduler(timezone=timezone.utc)
+    app.state.scheduler.add_job(
+        run_welfare_checks, "interval", minutes=5,
+        coalesce=True, max_instances=1
+    )
+    app.state.scheduler.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
+    app.state.scheduler.shutdown(wait=False)
+    await client.close()
+    await app.state.http.aclose()
+    await llm_client.close()
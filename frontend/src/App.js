@@ -392,10 +392,11 @@ const ChatInterface = () => {
       const storedSessionId = localStorage.getItem(`chat_session_${user.id}`);
       
       if (storedSessionId) {
-        // Load existing chat history
-        const response = await axios.get(`${API}/chat/history/${storedSessionId}`);
-        if (response.data.messages && response.data.messages.length > 0) {
-          setMessages(response.data.messages);
+        // Load existing chat history (NDJSON: one message per line)
+        const response = await axios.get(`${API}/chat/history/${storedSessionId}`, { responseType: 'text' });
+        const historyMessages = response.data.split('\n').filter(Boolean).map((line) => JSON.parse(line));
+        if (historyMessages.length > 0) {
+          setMessages(historyMessages);
           setSessionId(storedSessionId);
         } else {
           // No messages in this session, start fresh
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# server.py reads these at import time; nothing here talks to a real database
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length=None):
+        return list(self.docs)
+
+
+MISSING = object()
+
+
+def matches(doc, query):
+    """The subset of Mongo query semantics the welfare job uses.
+
+    Like BSON, $lt only compares values of the same type: a string never
+    sorts against a date.
+    """
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(matches(doc, branch) for branch in cond):
+                return False
+            continue
+        value = doc.get(key, MISSING)
+        if not isinstance(cond, dict):
+            if value != cond:
+                return False
+            continue
+        for op, arg in cond.items():
+            if op == "$exists":
+                ok = (value is not MISSING) == arg
+            elif op == "$lt":
+                ok = type(value) is type(arg) and value < arg
+            elif op == "$type":
+                ok = {"string": str, "date": datetime}[arg] is type(value)
+            elif op == "$in":
+                ok = value in arg
+            else:
+                raise NotImplementedError(op)
+            if not ok:
+                return False
+    return True
+
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, *args, **kwargs):
+        return FakeCursor([doc for doc in self.docs if matches(doc, query)])
+
+
+class FakeDB:
+    def __init__(self, welfare_settings, users):
+        self.welfare_settings = FakeCollection(welfare_settings)
+        self.users = FakeCollection(users)
+
+
+def run_checks(monkeypatch, welfare_settings, users):
+    delivered = []
+
+    async def fake_deliver(user_id, username, phone_number):
+        delivered.append(user_id)
+        return True
+
+    monkeypatch.setattr(server, "db", FakeDB(welfare_settings, users))
+    monkeypatch.setattr(server, "deliver_welfare_check", fake_deliver)
+    asyncio.run(server.run_welfare_checks())
+    return delivered
+
+
+def user(user_id):
+    return {"id": user_id, "username": user_id, "phone_number": "+15550000000"}
+
+
+def settings(user_id, last_activity, **extra):
+    return {"user_id": user_id, "enabled": True, "welfare_check_days": 3,
+            "last_activity": last_activity, **extra}
+
+
+def test_legacy_string_last_activity(monkeypatch):
+    now = datetime.now(timezone.utc)
+    welfare_settings = [
+        # Written by the old WhatsApp setup as an ISO string; must still be selected
+        settings("legacy_quiet", (now - timedelta(days=10)).isoformat()),
+        settings("legacy_quiet_z", (now - timedelta(days=10)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")),
+        settings("legacy_recent", (now - timedelta(hours=1)).isoformat()),
+        # Unreadable value is skipped without aborting the run
+        settings("garbage", "not a date"),
+        settings("quiet", now - timedelta(days=10)),
+    ]
+    users = [user(doc["user_id"]) for doc in welfare_settings]
+
+    delivered = run_checks(monkeypatch, welfare_settings, users)
+
+    assert delivered == ["legacy_quiet", "legacy_quiet_z", "quiet"]
+
+
+def test_datetime_last_activity(monkeypatch):
+    now = datetime.now(timezone.utc)
+    welfare_settings = [
+        # Already checked in on during this stretch of inactivity
+        settings("checked", now - timedelta(days=10), last_welfare_check=now - timedelta(days=2)),
+        # Checked during an earlier stretch: due again
+        settings("checked_before", now - timedelta(days=10), last_welfare_check=now - timedelta(days=20)),
+        settings("recent", now - timedelta(days=2)),
+        settings("disabled", now - timedelta(days=10), enabled=False),
+        # Settings created by WhatsApp activity alone have no user to check on
+        {"enabled": True, "last_activity": now - timedelta(days=10)},
+        settings("no_activity", None),
+    ]
+    users = [user(doc["user_id"]) for doc in welfare_settings if "user_id" in doc]
+
+    delivered = run_checks(monkeypatch, welfare_settings, users)
+
+    assert delivered == ["checked_before"]